@@ -1,9 +1,12 @@
 import os
 import time
-import json
-from typing import List, Dict
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Dict, Tuple
 
 import boto3
+from botocore.config import Config
 import gspread
 from google.oauth2.service_account import Credentials
 
@@ -15,17 +18,47 @@ GOOGLE_SHEETS_KEYFILE = os.getenv("GOOGLE_SHEETS_KEYFILE", "credentials.json")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 FORM_TAB = os.getenv("FORM_TAB", "Form Data")
 TABLE_TAB = os.getenv("TABLE_TAB", "Table Data")
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
+TEXTRACT_ASYNC = os.getenv("TEXTRACT_ASYNC", "false").lower() in ("1", "true", "yes")
+TEXTRACT_MAX_WAIT = float(os.getenv("TEXTRACT_MAX_WAIT", "900"))
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+# Adaptive retries absorb Textract throttling, and the pool is large enough
+# for every worker thread to keep its own connection alive.
+BOTO_CONFIG = Config(
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    max_pool_connections=max(32, MAX_WORKERS),
+    tcp_keepalive=True,
+)
+
+
+@lru_cache(maxsize=None)
+def get_s3_client(region: str):
+    """Return a shared S3 client for ``region``."""
+    return boto3.client("s3", region_name=region, config=BOTO_CONFIG)
+
+
+@lru_cache(maxsize=None)
+def get_textract_client(region: str):
+    """Return a shared Textract client for ``region``."""
+    return boto3.client("textract", region_name=region, config=BOTO_CONFIG)
 
 
 def list_pdfs(s3_client) -> List[str]:
     """List PDF keys under the specified prefix."""
     paginator = s3_client.get_paginator("list_objects_v2")
-    keys = []
-    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=S3_PREFIX):
-        for obj in page.get("Contents", []):
-            if obj["Key"].lower().endswith(".pdf"):
-                keys.append(obj["Key"])
-    return keys
+    pages = paginator.paginate(
+        Bucket=S3_BUCKET,
+        Prefix=S3_PREFIX,
+        PaginationConfig={"PageSize": 1000},
+    )
+    return [
+        obj["Key"]
+        for page in pages
+        for obj in page.get("Contents", ())
+        if obj["Key"].lower().endswith(".pdf")
+    ]
 
 
 def analyze_document(textract_client, key: str) -> Dict:
@@ -37,68 +70,100 @@ def analyze_document(textract_client, key: str) -> Dict:
     return response
 
 
-def build_kv_map(blocks: List[Dict]) -> Dict[str, str]:
-    key_map = {}
-    value_map = {}
-    block_map = {}
+def analyze_document_async(
+    textract_client, key: str, max_delay: float = 30.0, max_wait: float = TEXTRACT_MAX_WAIT
+) -> Iterator[Dict]:
+    """Run an asynchronous Textract job (needed for multi-page PDFs) and yield its blocks page by page."""
+    job_id = textract_client.start_document_analysis(
+        DocumentLocation={"S3Object": {"Bucket": S3_BUCKET, "Name": key}},
+        FeatureTypes=["TABLES", "FORMS"],
+    )["JobId"]
+
+    deadline = time.monotonic() + max_wait
+    delay = 1.0
+    while True:
+        response = textract_client.get_document_analysis(JobId=job_id)
+        if response["JobStatus"] != "IN_PROGRESS":
+            break
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Textract job {job_id} for {key} still running after {max_wait:.0f}s")
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+    if response["JobStatus"] == "FAILED":
+        raise RuntimeError(f"Textract job {job_id} failed for {key}: {response.get('StatusMessage', '')}")
+    if response["JobStatus"] == "PARTIAL_SUCCESS":
+        logging.warning("Textract job %s for %s only partially succeeded: %s",
+                        job_id, key, response.get("StatusMessage", ""))
+
+    yield from response.get("Blocks", [])
+    while response.get("NextToken"):
+        response = textract_client.get_document_analysis(JobId=job_id, NextToken=response["NextToken"])
+        yield from response.get("Blocks", [])
+
+
+def relationship_ids(block: Dict, rel_type: str) -> List[str]:
+    return next((rel["Ids"] for rel in block.get("Relationships", ()) if rel["Type"] == rel_type), [])
+
+
+def parse_blocks(blocks: Iterable[Dict]) -> Tuple[Dict[str, str], List[List[List[str]]]]:
+    """Walk Textract blocks once and return the form key/value pairs and tables.
+
+    Blocks are reduced to small indexes (word text, child ids, cell positions)
+    as they are read, so ``blocks`` can be a lazy stream of result pages.
+    """
+    key_values = {}
+    cell_pos = {}
+    table_ids = []
+    text_of = {}
+    child_ids = {}
+    # Branches are ordered by frequency (WORD blocks dominate) and kept inline,
+    # since per-block function calls are the main cost on large responses.
     for block in blocks:
-        block_id = block.get("Id")
-        block_map[block_id] = block
-        if block["BlockType"] == "KEY_VALUE_SET":
+        b_type = block["BlockType"]
+        if b_type == "WORD":
+            # Empty words would leave stray separators in the joined text.
+            text = block.get("Text")
+            if text:
+                text_of[block["Id"]] = text
+        elif b_type == "CELL":
+            cell_pos[block["Id"]] = (block["RowIndex"], block["ColumnIndex"])
+            child_ids[block["Id"]] = relationship_ids(block, "CHILD")
+        elif b_type == "KEY_VALUE_SET":
             if "KEY" in block.get("EntityTypes", []):
-                key_map[block_id] = block
-            else:
-                value_map[block_id] = block
+                value_ids = relationship_ids(block, "VALUE")
+                key_values[block["Id"]] = value_ids[0] if value_ids else None
+            child_ids[block["Id"]] = relationship_ids(block, "CHILD")
+        elif b_type == "SELECTION_ELEMENT":
+            if block.get("SelectionStatus") == "SELECTED":
+                text_of[block["Id"]] = "X"
+        elif b_type == "TABLE":
+            table_ids.append(block["Id"])
+            child_ids[block["Id"]] = relationship_ids(block, "CHILD")
+
     kv_pairs = {}
-    for key_id, key_block in key_map.items():
-        value_block = None
-        for rel in key_block.get("Relationships", []):
-            if rel["Type"] == "VALUE" and rel.get("Ids"):
-                value_id = rel["Ids"][0]
-                value_block = value_map.get(value_id)
-        key_text = extract_text(key_block, block_map)
-        val_text = extract_text(value_block, block_map) if value_block else ""
-        kv_pairs[key_text] = val_text
-    return kv_pairs
-
-
-def extract_text(block, block_map) -> str:
-    if not block:
-        return ""
-    text = ""
-    for rel in block.get("Relationships", []):
-        if rel["Type"] == "CHILD" and rel.get("Ids"):
-            for cid in rel["Ids"]:
-                word = block_map[cid]
-                if word.get("BlockType") == "WORD":
-                    text += word.get("Text", "") + " "
-                elif word.get("BlockType") == "SELECTION_ELEMENT":
-                    if word.get("SelectionStatus") == "SELECTED":
-                        text += "X "
-    return text.strip()
-
-
-def extract_tables(blocks: List[Dict]) -> List[List[str]]:
-    block_map = {b["Id"]: b for b in blocks}
+    for key_id, value_id in key_values.items():
+        key_text = extract_text(key_id, text_of, child_ids)
+        kv_pairs[key_text] = extract_text(value_id, text_of, child_ids) if value_id else ""
+
     tables = []
-    for block in blocks:
-        if block["BlockType"] == "TABLE":
-            rows = {}
-            for rel in block.get("Relationships", []):
-                if rel["Type"] == "CHILD":
-                    for cell_id in rel.get("Ids", []):
-                        cell = block_map[cell_id]
-                        if cell["BlockType"] == "CELL":
-                            row_idx = cell["RowIndex"]
-                            col_idx = cell["ColumnIndex"]
-                            rows.setdefault(row_idx, {})[col_idx] = extract_text(cell, block_map)
-            table_data = []
-            for row_idx in sorted(rows.keys()):
-                row = rows[row_idx]
-                row_values = [row.get(c, "") for c in sorted(row.keys())]
-                table_data.append(row_values)
-            tables.append(table_data)
-    return tables
+    for table_id in table_ids:
+        cell_ids = [cid for cid in child_ids[table_id] if cid in cell_pos]
+        if not cell_ids:
+            tables.append([])
+            continue
+        # Textract row/column indices are 1-based and contiguous, so cells map straight onto a grid.
+        max_row = max(cell_pos[cid][0] for cid in cell_ids)
+        max_col = max(cell_pos[cid][1] for cid in cell_ids)
+        grid = [[""] * max_col for _ in range(max_row)]
+        for cid in cell_ids:
+            row_idx, col_idx = cell_pos[cid]
+            grid[row_idx - 1][col_idx - 1] = extract_text(cid, text_of, child_ids)
+        tables.append(grid)
+    return kv_pairs, tables
+
+
+def extract_text(block_id: str, text_of: Dict[str, str], child_ids: Dict[str, List[str]]) -> str:
+    return " ".join(text_of[cid] for cid in child_ids.get(block_id, ()) if cid in text_of)
 
 
 def authorize_gspread():
@@ -111,45 +176,89 @@ def authorize_gspread():
     return client
 
 
-def append_form_data(sh, data: Dict[str, str]):
-    worksheet = sh.worksheet(FORM_TAB)
-    headers = worksheet.row_values(1)
-    row = [data.get(h, "") for h in headers]
-    worksheet.append_row(row)
+def build_form_row(headers: List[str], data: Dict[str, str]) -> List[str]:
+    return [data.get(h, "") for h in headers]
+
 
+def append_cells_request(worksheet, rows: List[List[str]]) -> Dict:
+    return {
+        "appendCells": {
+            "sheetId": worksheet.id,
+            "rows": [
+                {"values": [{"userEnteredValue": {"stringValue": value}} for value in row]}
+                for row in rows
+            ],
+            "fields": "userEnteredValue",
+        }
+    }
 
-def append_table_data(sh, table: List[List[str]], source_key: str):
-    worksheet = sh.worksheet(TABLE_TAB)
-    for row in table:
-        worksheet.append_row([source_key] + row)
 
+def append_data(sh, rows_by_worksheet: List[Tuple[object, List[List[str]]]]):
+    """Append rows to several worksheets with a single spreadsheets.batchUpdate call."""
+    requests = [append_cells_request(ws, rows) for ws, rows in rows_by_worksheet if rows]
+    if requests:
+        sh.batch_update({"requests": requests})
 
-def process_pdf(textract_client, key: str, sh):
-    response = analyze_document(textract_client, key)
-    blocks = response.get("Blocks", [])
-    kv_pairs = build_kv_map(blocks)
-    append_form_data(sh, kv_pairs)
-    tables = extract_tables(blocks)
-    for table in tables:
-        append_table_data(sh, table, key)
+
+def process_pdf(textract_client, key: str, headers: List[str]) -> Tuple[List[str], List[List[str]]]:
+    """Extract one PDF and return its form row and source-tagged table rows."""
+    if TEXTRACT_ASYNC:
+        blocks = analyze_document_async(textract_client, key)
+    else:
+        # The synchronous call is faster but rejects multi-page and oversized PDFs.
+        try:
+            blocks = analyze_document(textract_client, key).get("Blocks", [])
+        except (
+            textract_client.exceptions.UnsupportedDocumentException,
+            textract_client.exceptions.DocumentTooLargeException,
+        ):
+            logging.info("%s needs asynchronous analysis; starting a Textract job", key)
+            blocks = analyze_document_async(textract_client, key)
+    kv_pairs, tables = parse_blocks(blocks)
+    form_row = build_form_row(headers, kv_pairs)
+    table_rows = [[key] + row for table in tables for row in table]
+    return form_row, table_rows
 
 
 def main():
     if not all([S3_BUCKET, SPREADSHEET_ID]):
         raise ValueError("S3_BUCKET and SPREADSHEET_ID environment variables must be set")
 
-    s3 = boto3.client("s3", region_name=AWS_REGION)
-    textract = boto3.client("textract", region_name=AWS_REGION)
-    keys = list_pdfs(s3)
+    textract = get_textract_client(AWS_REGION)
+    keys = list_pdfs(get_s3_client(AWS_REGION))
 
     gs_client = authorize_gspread()
     sh = gs_client.open_by_key(SPREADSHEET_ID)
+    form_ws = sh.worksheet(FORM_TAB)
+    table_ws = sh.worksheet(TABLE_TAB)
+    headers = form_ws.row_values(1)
+
+    def run(key: str):
+        # One bad PDF must not discard the rows of those already processed.
+        try:
+            return process_pdf(textract, key, headers)
+        except Exception as e:
+            logging.error("Failed to process %s: %s", key, e)
+            return None
+
+    all_form_rows = []
+    all_table_rows = []
+    failed = []
+    # Textract calls are network-bound, so overlap them across threads.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for key, result in zip(keys, executor.map(run, keys)):
+            if result is None:
+                failed.append(key)
+                continue
+            form_row, table_rows = result
+            logging.info("Processed %s", key)
+            all_form_rows.append(form_row)
+            all_table_rows.extend(table_rows)
 
-    for key in keys:
-        print(f"Processing {key}...", flush=True)
-        process_pdf(textract, key, sh)
-        time.sleep(0.2)  # avoid hitting API rate limits
-    print("Done")
+    append_data(sh, [(form_ws, all_form_rows), (table_ws, all_table_rows)])
+    if failed:
+        logging.warning("Skipped %d PDF(s): %s", len(failed), ", ".join(failed))
+    logging.info("Done")
 
 
 if __name__ == "__main__":
@@ -2,27 +2,57 @@
 """Process an invoice PDF from S3 using Textract queries and summarize with OpenAI."""
 
 import os
+import re
 import sys
+import json
+import time
+import random
 import logging
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Tuple
 
 import boto3
 import openai
+from botocore.config import Config
 import gspread
 from google.oauth2.service_account import Credentials
 from dateutil import parser as date_parser
 
+try:
+    import tiktoken
+except ImportError:  # optional; token counts are estimated from characters instead
+    tiktoken = None
+
 # Constants for Textract adapter (replace with real IDs)
 ADAPTER_ID = "YOUR_ADAPTER_ID"
 ADAPTER_VERSION = "1"
 
+# Invoices packed into one summarization prompt; returns diminish past ~5-20.
+SUMMARY_BATCH_SIZE = int(os.getenv("SUMMARY_BATCH_SIZE", "10"))
+# Concurrent OpenAI requests; rate-limit errors beyond this are retried with backoff.
+OPENAI_MAX_WORKERS = int(os.getenv("OPENAI_MAX_WORKERS", "8"))
+# Upper bound on invoice text sent for summarization.
+MAX_SUMMARY_TOKENS = 4000
+
+# Common invoice date layouts tried before falling back to dateutil's fuzzy parser.
+DATE_PATTERN = re.compile(r"\d{1,4}[/-]\d{1,2}[/-]\d{1,4}")
+DATE_FORMATS = ("%m/%d/%Y", "%Y-%m-%d", "%Y/%m/%d", "%m-%d-%Y", "%B %d, %Y", "%b %d, %Y")
+
+# Models sometimes wrap JSON replies in a Markdown code fence despite instructions.
+CODE_FENCE_PATTERN = re.compile(r"^\s*```(?:json)?\s*(.*?)\s*```\s*$", re.DOTALL)
+# Per-document summary budget, plus headroom for the JSON keys, quotes and escapes around it.
+SUMMARY_MAX_TOKENS = 150
+JSON_OVERHEAD_TOKENS = 30
+
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
+@lru_cache(maxsize=None)
 def load_config() -> Dict[str, str]:
-    """Load required configuration from environment variables."""
+    """Load required configuration from environment variables (validated once per process)."""
+    # AWS credentials come from boto3's default chain (env, shared config, instance profile).
     env_vars = [
-        "AWS_ACCESS_KEY_ID",
-        "AWS_SECRET_ACCESS_KEY",
         "AWS_REGION",
         "S3_BUCKET_NAME",
         "OPENAI_API_KEY",
@@ -41,6 +71,15 @@ def load_config() -> Dict[str, str]:
         raise EnvironmentError(f"Missing environment variables: {', '.join(missing)}")
     return config
 
+@lru_cache(maxsize=None)
+def get_textract_client(region: str):
+    """Return a shared Textract client for ``region``."""
+    return boto3.client(
+        "textract",
+        region_name=region,
+        config=Config(retries={"max_attempts": 10, "mode": "adaptive"}, tcp_keepalive=True),
+    )
+
 def analyze_document(textract_client, bucket: str, key: str) -> Dict:
     """Call Textract AnalyzeDocument with queries."""
     try:
@@ -84,25 +123,70 @@ def parse_response(response: Dict) -> Dict[str, str]:
 
     if "Date" in results:
         try:
-            dt = date_parser.parse(results["Date"], fuzzy=True)
+            dt = parse_date(results["Date"])
             results["Date"] = dt.strftime("%Y/%m/%d")
         except Exception as e:
             logging.warning("Failed to parse date '%s': %s", results["Date"], e)
 
-    results["full_text"] = "\n".join(full_lines)
+    results["full_text"] = truncate_tokens("\n".join(full_lines))
     return results
 
+def parse_date(text: str) -> datetime:
+    """Parse an invoice date, trying known formats before the fuzzy parser."""
+    match = DATE_PATTERN.search(text)
+    candidate = match.group(0) if match else text.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(candidate, fmt)
+        except ValueError:
+            continue
+    return date_parser.parse(text, fuzzy=True)
+
+@lru_cache(maxsize=None)
+def get_token_encoding():
+    """Return gpt-4o-mini's o200k_base encoding, or None if tiktoken can't provide it."""
+    if tiktoken is None:
+        return None
+    # Older tiktoken releases lack o200k_base, and a cold cache downloads it.
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning("tiktoken encoding unavailable (%s); estimating tokens from characters", e)
+        return None
+
+def truncate_tokens(text: str, max_tokens: int = MAX_SUMMARY_TOKENS) -> str:
+    """Cap text at ``max_tokens`` gpt-4o-mini tokens."""
+    encoding = get_token_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]  # roughly four characters per token
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+def chat_completion(max_retries: int = 5, **kwargs) -> Dict:
+    """Call ChatCompletion, retrying rate-limit errors with jittered exponential backoff."""
+    for attempt in range(max_retries):
+        try:
+            return openai.ChatCompletion.create(**kwargs)
+        except openai.error.RateLimitError:
+            if attempt == max_retries - 1:
+                raise
+            delay = min(2 ** attempt, 30) * random.uniform(0.5, 1.5)
+            logging.warning("OpenAI rate limit hit; retrying in %.1fs", delay)
+            time.sleep(delay)
+
 def summarize_text(full_text: str, api_key: str) -> str:
     """Use OpenAI ChatCompletion to summarize text."""
     openai.api_key = api_key
     try:
-        response = openai.ChatCompletion.create(
+        response = chat_completion(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "You are a concise summarizer."},
                 {"role": "user", "content": full_text},
             ],
-            max_tokens=150,
+            max_tokens=SUMMARY_MAX_TOKENS,
         )
         summary = response["choices"][0]["message"]["content"].strip()
         return summary
@@ -110,53 +194,156 @@ def summarize_text(full_text: str, api_key: str) -> str:
         logging.error("OpenAI API call failed: %s", e)
         raise
 
-def append_to_sheet(creds_file: str, sheet_id: str, row: List[str]) -> None:
-    """Append a row to the Form Data sheet."""
+def summarize_texts(docs: List[Tuple[str, str]], api_key: str, batch_size: int = SUMMARY_BATCH_SIZE) -> Dict[str, str]:
+    """Summarize (id, full_text) pairs, packing up to ``batch_size`` documents per request.
+
+    Requests are issued concurrently on up to ``OPENAI_MAX_WORKERS`` threads.
+    Documents that cannot be summarized are left out of the result.
+    """
+    def summarize(batch: List[Tuple[str, str]]) -> Dict[str, str]:
+        if len(batch) == 1:
+            return summarize_each(batch, api_key)
+        return summarize_batch(batch, api_key)
+
+    batches = [docs[start:start + batch_size] for start in range(0, len(docs), batch_size)]
+    summaries: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=OPENAI_MAX_WORKERS) as executor:
+        for result in executor.map(summarize, batches):
+            summaries.update(result)
+    return summaries
+
+def summarize_each(docs: List[Tuple[str, str]], api_key: str) -> Dict[str, str]:
+    """Summarize documents one request at a time, omitting any that fail."""
+    summaries: Dict[str, str] = {}
+    for doc_id, full_text in docs:
+        try:
+            summaries[doc_id] = summarize_text(full_text, api_key)
+        except Exception as e:
+            logging.error("Could not summarize %s: %s", doc_id, e)
+    return summaries
+
+def summarize_batch(batch: List[Tuple[str, str]], api_key: str) -> Dict[str, str]:
+    """Summarize several documents in one ChatCompletion call with a JSON reply."""
+    openai.api_key = api_key
+    # Positional ids keep the delimiters and JSON keys independent of S3 key characters.
+    prompt = "\n\n".join(
+        f"<<<DOC id={i}>>>\n{full_text}\n<<<END DOC>>>" for i, (_, full_text) in enumerate(batch)
+    )
+    try:
+        response = chat_completion(
+            model="gpt-4o-mini",
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "You are a concise summarizer. Summarize each document delimited by "
+                        "<<<DOC id=...>>> markers separately. Reply with only a JSON object "
+                        "mapping each document id to its summary."
+                    ),
+                },
+                {"role": "user", "content": prompt},
+            ],
+            response_format={"type": "json_object"},
+            max_tokens=(SUMMARY_MAX_TOKENS + JSON_OVERHEAD_TOKENS) * len(batch) + JSON_OVERHEAD_TOKENS,
+        )
+        content = response["choices"][0]["message"]["content"]
+    except Exception as e:
+        logging.warning("Batch summary request failed (%s); summarizing individually", e)
+        return summarize_each(batch, api_key)
+
+    fenced = CODE_FENCE_PATTERN.match(content)
+    if fenced:
+        content = fenced.group(1)
+    try:
+        parsed = json.loads(content)
+    except ValueError:
+        logging.warning("Batch summary reply was not valid JSON; summarizing individually")
+        parsed = {}
+
+    summaries: Dict[str, str] = {}
+    missing = []
+    for i, (doc_id, full_text) in enumerate(batch):
+        summary = parsed.get(str(i)) if isinstance(parsed, dict) else None
+        if isinstance(summary, str) and summary.strip():
+            summaries[doc_id] = summary.strip()
+        else:
+            missing.append((doc_id, full_text))
+    summaries.update(summarize_each(missing, api_key))
+    return summaries
+
+@lru_cache(maxsize=None)
+def get_worksheet(creds_file: str, sheet_id: str):
+    """Return the Form Data worksheet, authorizing once per credentials file and sheet."""
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
         "https://www.googleapis.com/auth/drive",
     ]
     credentials = Credentials.from_service_account_file(creds_file, scopes=scopes)
     client = gspread.authorize(credentials)
+    return client.open_by_key(sheet_id).worksheet("Form Data")
+
+def append_to_sheet(creds_file: str, sheet_id: str, rows: List[List[str]]) -> None:
+    """Append rows to the Form Data sheet in a single request."""
     try:
-        sheet = client.open_by_key(sheet_id)
-        worksheet = sheet.worksheet("Form Data")
-        worksheet.append_row(row)
+        worksheet = get_worksheet(creds_file, sheet_id)
+        # RAW skips formula evaluation; pinning the header range spares the API a table scan.
+        worksheet.append_rows(
+            rows,
+            value_input_option="RAW",
+            insert_data_option="INSERT_ROWS",
+            table_range="A1:D1",
+        )
     except Exception as e:
         logging.error("Failed to update Google Sheet: %s", e)
         raise
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: process_invoice.py <s3_key>")
+    if len(sys.argv) < 2:
+        print("Usage: process_invoice.py <s3_key> [<s3_key> ...]")
         sys.exit(1)
-    s3_key = sys.argv[1]
+    s3_keys = sys.argv[1:]
 
     config = load_config()
     openai.api_key = config["OPENAI_API_KEY"]
 
-    textract = boto3.client(
-        "textract",
-        aws_access_key_id=config["AWS_ACCESS_KEY_ID"],
-        aws_secret_access_key=config["AWS_SECRET_ACCESS_KEY"],
-        region_name=config["AWS_REGION"],
-    )
+    textract = get_textract_client(config["AWS_REGION"])
 
-    logging.info("Analyzing %s from bucket %s", s3_key, config["S3_BUCKET_NAME"])
-    response = analyze_document(textract, config["S3_BUCKET_NAME"], s3_key)
-    parsed = parse_response(response)
+    parsed_docs = {}
+    skipped = []
+    for s3_key in s3_keys:
+        logging.info("Analyzing %s from bucket %s", s3_key, config["S3_BUCKET_NAME"])
+        # A bad invoice is skipped so the rest of the run still reaches the sheet.
+        try:
+            response = analyze_document(textract, config["S3_BUCKET_NAME"], s3_key)
+            parsed_docs[s3_key] = parse_response(response)
+        except Exception as e:
+            logging.error("Skipping %s: %s", s3_key, e)
+            skipped.append(s3_key)
 
-    summary = summarize_text(parsed["full_text"], config["OPENAI_API_KEY"])
-    parsed["Description"] = summary
+    summaries = summarize_texts(
+        [(s3_key, parsed["full_text"]) for s3_key, parsed in parsed_docs.items()],
+        config["OPENAI_API_KEY"],
+    )
 
-    row = [
-        parsed.get("Title", ""),
-        parsed.get("Date", ""),
-        parsed.get("Description", ""),
-        parsed.get("VolumeIssueNumber", ""),
-    ]
-    append_to_sheet(config["GOOGLE_CREDENTIALS_FILE"], config["GOOGLE_SHEET_ID"], row)
-    logging.info("Row appended successfully")
+    rows = []
+    for s3_key, parsed in parsed_docs.items():
+        if s3_key not in summaries:
+            skipped.append(s3_key)
+            continue
+        parsed["Description"] = summaries[s3_key]
+        rows.append([
+            parsed.get("Title", ""),
+            parsed.get("Date", ""),
+            parsed.get("Description", ""),
+            parsed.get("VolumeIssueNumber", ""),
+        ])
+    if rows:
+        append_to_sheet(config["GOOGLE_CREDENTIALS_FILE"], config["GOOGLE_SHEET_ID"], rows)
+    logging.info("Appended %d row(s)", len(rows))
+
+    if skipped:
+        logging.error("Skipped %d invoice(s): %s", len(skipped), ", ".join(skipped))
+        sys.exit(1)
 
 if __name__ == "__main__":
     try: